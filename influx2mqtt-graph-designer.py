@@ -3,12 +3,20 @@
 # 2022-05-06
 
 import sys
+import time
+import queue
 import logging
+import threading
 import configparser
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
+import msgpack
 
 from paho.mqtt import client as mqtt_client
 from influxdb_client import InfluxDBClient, QueryApi
-from influxdb_client.client.query_api import FluxTable, FluxRecord
+from influxdb_client.client.query_api import FluxRecord
 
 
 # InfluxDB Connector Class
@@ -31,18 +39,30 @@ class Model:
 
         self.database: InfluxDBClient = None
         self.api: QueryApi = None
+        self.query_template: str = None
+        self.query: str = None
 
-    # Connect Model to InfluxDB
+    # Connect Model to InfluxDB; the Client is reused for all queries
     def connect(self):
+        if self.database is not None:
+            return
+
         self.database: InfluxDBClient = InfluxDBClient(
             url=self.configuration["url"],
             token=self.configuration["token"],
             org=self.configuration["organisation"],
-            bucket=self.configuration["bucket"]
+            bucket=self.configuration["bucket"],
+            connection_pool_maxsize=self.configuration.getint("connection_pool_maxsize", fallback=4),
+            retries=self.configuration.getint("retries", fallback=3)
         )
 
         self.api: QueryApi = self.database.query_api()
 
+        with open(self.configuration["query"], "r") as query_file:
+            self.query_template: str = query_file.read()
+
+        self.query: str = self.query_template.format(start='-7d', stop='0d')
+
         if self.is_connected():
             self.logger.info(f"Model is connected", extra=self.logging_inf)
         else:
@@ -52,37 +72,28 @@ class Model:
     def is_connected(self) -> bool:
         return self.database.ping()
 
-    # Read Influxql query from file
+    # Return the cached Influxql query
     def get_query(self) -> str:
-        with open(self.configuration["query"], "r") as query_file:
-            query: str = query_file.read()
+        return self.query
 
-        return query
-
-    # Exec InfluxQL Query
+    # Exec InfluxQL Query; aggregation happens server-side
     def get_data(self) -> iter:
-        query: str = self.get_query()
-
-        for start, stop in (
-                ('-1d', '0d'), ('-2d', '-1d'), ('-3d', '-2d'),
-                ('-4d', '-3d'), ('-5d', '-4d'), ('-6d', '-5d'), ('-7d', '-6d')
-        ):
-            q = query.format(start=start, stop=stop)
+        empty: bool = True
 
-            tables: list[FluxTable] = self.api.query(q)
+        record: FluxRecord
+        for record in self.api.query_stream(self.query):
+            empty = False
 
-            if len(tables) > 0:
-                for table in tables:
-                    record: FluxRecord
-                    for record in table.records:
+            yield record.get_value()
 
-                        yield int(record.get_value())
-            else:
-                yield 0
+        if empty:
+            yield 0
 
     # Disconnect from InfluxDB
-    def __del__(self):
-        self.database.close()
+    def close(self) -> None:
+        if self.database is not None:
+            self.database.close()
+            self.database: InfluxDBClient = None
 
 
 # MQTT Class as API
@@ -104,26 +115,81 @@ class API:
         self.logger: logging.Logger = logger
 
         self.api: mqtt_client.Client = mqtt_client.Client(
-            self.configuration["userid"]
+            client_id=self.configuration["userid"],
+            clean_session=False,
+            transport=self.configuration.get("transport", fallback="tcp")
         )
+        self.api.max_inflight_messages_set(self.configuration.getint("max_inflight", fallback=20))
+        self.api.max_queued_messages_set(self.configuration.getint("max_queued", fallback=100))
+
         self.trigger_func: any = None
 
+        self.trigger_topic: str = self.configuration["trigger"]
+        self.post_topic: str = self.configuration["post"]
+
+        self.encoding: str = self.configuration.get("encoding", fallback="json")
+
+        self.batch_size: int = self.configuration.getint("batch_size", fallback=10)
+        self.batch_timeout_ms: int = self.configuration.getint("batch_timeout_ms", fallback=200)
+
+        self.triggers: queue.Queue = queue.Queue(maxsize=100)
+        self.worker: threading.Thread = threading.Thread(target=self.__work, daemon=True)
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=self.configuration.getint("workers", fallback=2)
+        )
+
     # On Connection
     def __on_connect(self, client, userdata, flags, rc) -> None:
         if rc == 0:
             self.logger.info("API is connected", extra=self.logging_inf)
-            self.api.subscribe(topic=self.configuration["trigger"])
+            self.api.subscribe(topic=self.trigger_topic)
             return
 
         self.logger.warning("API is not connected", extra=self.logging_inf)
-        self.api.subscribe(topic=self.configuration["trigger"])
+        self.api.subscribe(topic=self.trigger_topic)
 
     # On Message
     def __on_message(self, client, userdata, msg: mqtt_client.MQTTMessage):
-        self.logger.debug(f"msg: {msg.topic} = '{msg.payload.decode('UTF-8')}'", extra=self.logging_inf)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("msg: %s = '%s'", msg.topic, msg.payload.decode("UTF-8"), extra=self.logging_inf)
+
+        if msg.topic == self.trigger_topic:
+            try:
+                self.triggers.put_nowait(msg.payload)
+            except queue.Full:
+                self.logger.warning("Trigger queue is full", extra=self.logging_inf)
+
+    # Coalesce queued Triggers into one Batch
+    def __work(self) -> None:
+        while True:
+            self.triggers.get()
+            batch: int = 1
 
-        if msg.topic == self.configuration["trigger"]:
-            self.send(topic=self.configuration["post"], data=f"{self.trigger_func()}")
+            deadline: float = time.monotonic() + self.batch_timeout_ms / 1000
+
+            while batch < self.batch_size:
+                timeout: float = deadline - time.monotonic()
+
+                if timeout <= 0:
+                    break
+
+                try:
+                    self.triggers.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+                batch += 1
+
+            self.logger.debug("%s triggers in batch", batch, extra=self.logging_inf)
+
+            self.executor.submit(self.__handle_batch)
+
+    # Query and publish one Batch
+    def __handle_batch(self) -> None:
+        try:
+            self.send(topic=self.post_topic, data=self.trigger_func())
+        except Exception:
+            self.logger.exception("Batch failed", extra=self.logging_inf)
 
     # Connect API to MQTT
     def connect(self) -> None:
@@ -144,20 +210,34 @@ class API:
         )
 
     # Send Data to Topic
-    def send(self, topic: str, data: str) -> None:
-        self.api.publish(topic=topic, payload=data)
+    def send(self, topic: str, data: any) -> None:
+        if self.encoding == "msgpack":
+            payload: bytes = msgpack.packb(data)
+        else:
+            payload: bytes = orjson.dumps(data)
+
+        self.api.publish(topic=topic, payload=payload, qos=0, retain=True)
 
     # Main Subscribe Loop
     def sub_loop(self) -> None:
         self.connect()
 
+        if not self.worker.is_alive():
+            self.worker.start()
+
+        self.api.loop_start()
+
         try:
-            self.api.loop_forever()
+            while True:
+                time.sleep(1)
         except KeyboardInterrupt:
             self.logger.info(">> End <<", extra=self.logging_inf)
+        finally:
+            self.api.loop_stop()
 
     # Disconnect api
-    def __del__(self):
+    def close(self) -> None:
+        self.executor.shutdown(wait=False)
         self.api.disconnect()
 
 
@@ -184,6 +264,10 @@ class GraphDesigner:
         self.model: Model = model
         self.api: API = api
 
+        self.cache_ttl: float = self.configuration.getfloat("designer", "cache_ttl", fallback=1.0)
+        self.cached_result: list = None
+        self.cached_at: float = 0.0
+
         self.api.trigger_func = self.make
 
     # Start Main Loop
@@ -194,17 +278,23 @@ class GraphDesigner:
 
         self.api.sub_loop()
 
-    # Select Data from InfluxDB
-    def make(self) -> dict:
+    # Select Data from InfluxDB; recent results are served from cache
+    def make(self) -> list:
         self.logger.info("Trigger via API", extra=self.logging_inf)
 
-        data: tuple = tuple(self.model.get_data())
+        now: float = time.monotonic()
+
+        if self.cached_result is not None and now - self.cached_at < self.cache_ttl:
+            self.logger.debug("Result served from cache", extra=self.logging_inf)
+            return self.cached_result
 
-        result: dict = {}
+        result: list = list(self.model.get_data())
 
-        for nr, d in enumerate(data):
-            self.logger.debug(d, extra=self.logging_inf)
-            result[f'{nr}'] = d
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("result: %s", result, extra=self.logging_inf)
+
+        self.cached_result: list = result
+        self.cached_at: float = now
 
         return result
 
@@ -228,5 +318,7 @@ if __name__ == "__main__":
 
     # Init Graph Designer
     g: GraphDesigner = GraphDesigner(model=m, api=a, configuration=config, logger=l)
-    # Start Designer
-    g.start()
+
+    # Start Designer; disconnect Model and API on the way out
+    with closing(m), closing(a):
+        g.start()